@@ -4,48 +4,191 @@ import unittest
 import subprocess
 import os
 import time
+import errno
 import shutil
+import mmap
 import tempfile
-import hashlib
-import random
-import string
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 SOURCE_FILE = "xxxxx"
 
-class FuseFilesystemTest(unittest.TestCase):
-    FUSE_PROGRAM = '../build/splinterfs'  
-    MOUNTPOINT = '/tmp/' + ''.join(random.choices(string.ascii_letters, k=8))
+
+def _split_index(name, _partition=str.partition):
+    # Sort key for "<split_number>_<filename>" names
+    return int(_partition(name, '_')[0])
+
+
+def _wait_mounted(mountpoint, process, timeout=5.0):
+    # Poll /proc/self/mountinfo until the FUSE filesystem shows up, failing fast if the daemon exits
+    mountpoint = os.path.realpath(mountpoint)
+    deadline = time.monotonic() + timeout
+    while True:
+        # splinterfs daemonizes once mounted, so check for an exit before reading mountinfo
+        returncode = process.poll()
+        with open('/proc/self/mountinfo') as f:
+            # Field 5 is the mount point, with spaces escaped as \040
+            if any(line.split()[4].replace('\\040', ' ') == mountpoint for line in f):
+                return
+        if returncode is not None:
+            raise RuntimeError(f"FUSE daemon exited with code {returncode} without mounting {mountpoint}.")
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{mountpoint} was not mounted within {timeout}s.")
+        time.sleep(0.005)
+
+
+def _wait_for_size(mountpoint, size, timeout=5.0):
+    # Poll until the splits add up to the source size, outliving the kernel attribute cache
+    deadline = time.monotonic() + timeout
+    while sum(os.stat(os.path.join(mountpoint, f)).st_size for f in os.listdir(mountpoint)) != size:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{mountpoint} did not reach {size} bytes within {timeout}s.")
+        time.sleep(0.005)
+
+
+def _sha256_file(path):
+    # Hash the file in 1 MiB chunks rather than reading it whole into memory
+    import hashlib
+
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        h = hashlib.sha256()
+        mv = memoryview(bytearray(1 << 20))
+        while (n := f.readinto(mv)):
+            h.update(mv[:n])
+        return h.hexdigest()
+
+
+def _first_difference(path1, path2, window=4 << 20):
+    # Compare both files through read-only mmaps in 4 MiB windows, returning the offset of the
+    # first differing byte (or of the end of the shorter file), or None when they are identical
+    size1, size2 = os.stat(path1).st_size, os.stat(path2).st_size
+    size = min(size1, size2)
+    if size:
+        with open(path1, 'rb') as f1, open(path2, 'rb') as f2, \
+                mmap.mmap(f1.fileno(), 0, prot=mmap.PROT_READ) as m1, \
+                mmap.mmap(f2.fileno(), 0, prot=mmap.PROT_READ) as m2:
+            for offset in range(0, size, window):
+                end = min(offset + window, size)
+                if m1[offset:end] != m2[offset:end]:
+                    # Halve the differing range until only its first byte is left
+                    while end - offset > 1:
+                        middle = (offset + end) // 2
+                        if m1[offset:middle] == m2[offset:middle]:
+                            offset = middle
+                        else:
+                            end = middle
+                    return offset
+    return None if size1 == size2 else size
+
+
+def _append_file(src, dst):
+    # Append src to dst in the kernel with copy_file_range, falling back to a buffered copy
+    with open(src, 'rb') as infile, open(dst, 'r+b') as outfile:
+        copied = 0
+        offset = os.fstat(outfile.fileno()).st_size
+        try:
+            while (n := os.copy_file_range(infile.fileno(), outfile.fileno(), 1 << 24, copied, offset + copied)):
+                copied += n
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+        infile.seek(copied)
+        outfile.seek(offset + copied)
+        shutil.copyfileobj(infile, outfile, 1 << 20)
+
+
+def _combine_splits(mountpoint, files, dst, max_workers=None):
+    # Read the splits concurrently, each one written straight into dst after the splits before it,
+    # so that a short or long split shifts everything after it like a plain concatenation
+    splits = [os.path.join(mountpoint, file) for file in files]
+    sizes = [os.stat(split).st_size for split in splits]
+    offsets = itertools.accumulate(sizes, initial=0)
+
+    def copy_split(split, size, offset):
+        with open(split, 'rb') as infile, open(dst, 'r+b') as outfile:
+            copied = 0
+            while (chunk := os.pread(infile.fileno(), 1 << 20, copied)):
+                os.pwrite(outfile.fileno(), chunk, offset + copied)
+                copied += len(chunk)
+        if copied != size:
+            raise AssertionError(f"Read {copied} bytes from {split}, which stats at {size} bytes.")
+
+    open(dst, 'wb').close()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Consume the results so that any read error or size mismatch is raised here
+        list(executor.map(copy_split, splits, sizes, offsets))
+
+
+class _FuseMountTestCase(unittest.TestCase):
+    # Mounts splinterfs once and shares the mount between all tests of the class
+    FUSE_PROGRAM = '../build/splinterfs'
     SPLIT_SIZE = 100048576
     SOURCE_FILE = SOURCE_FILE
-    BASE_NAME = os.path.basename(SOURCE_FILE)
     FUSE_PID = None
 
+    @classmethod
+    def prepare_source(cls):
+        # File exposed through the mount, overridden by tests that mutate it.
+        # Called once the scratch directory exists.
+        return cls.SOURCE_FILE
+
     @classmethod
     def setUpClass(cls):
-        # Create mountpoint directory
-        os.makedirs(cls.MOUNTPOINT, exist_ok=True)
+        # Threads reading splits concurrently, set SPLINTERFS_READ_WORKERS=1 to read them one at a time
+        cls.READ_WORKERS = int(os.environ.get('SPLINTERFS_READ_WORKERS') or os.cpu_count() or 1)
+        if cls.READ_WORKERS < 1:
+            raise ValueError(f"SPLINTERFS_READ_WORKERS must be at least 1, found {cls.READ_WORKERS}.")
+
+        # Size of the original source, stat'ed once for all tests
+        cls._source_size = os.stat(cls.SOURCE_FILE).st_size
+
+        # Scratch directory holding the mountpoint and any other files, picked at run time.
+        # Its removal tolerates errors, as the mount may outlive a failed unmount.
+        cls._tmp_dir = tempfile.mkdtemp(prefix='splinterfs_')
+        cls.addClassCleanup(shutil.rmtree, cls._tmp_dir, ignore_errors=True)
+        cls.MOUNTPOINT = os.path.join(cls._tmp_dir, 'mnt')
+        os.mkdir(cls.MOUNTPOINT)
 
         # Start FUSE filesystem
-        cls.fuse_process = subprocess.Popen([cls.FUSE_PROGRAM, cls.SOURCE_FILE, cls.MOUNTPOINT])
+        cls.fuse_process = subprocess.Popen([cls.FUSE_PROGRAM, cls.prepare_source(), cls.MOUNTPOINT])
+        cls.addClassCleanup(cls._unmount)
         cls.FUSE_PID = cls.fuse_process.pid
-        time.sleep(2)  # Wait for filesystem to initialize
+        _wait_mounted(cls.MOUNTPOINT, cls.fuse_process)
 
     @classmethod
-    def tearDownClass(cls):
-        # Unmount the filesystem
-        subprocess.run(['fusermount', '-u', cls.MOUNTPOINT], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    def _unmount(cls):
+        # Class cleanups also run when setUpClass fails, e.g. on a mount timeout,
+        # and in reverse order, so this happens before the scratch directory is removed
+        result = subprocess.run(['fusermount', '-u', cls.MOUNTPOINT], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if result.returncode != 0:
+            # Still busy: detach the mount lazily, the daemon exits once it is released
+            result = subprocess.run(['fusermount', '-u', '-z', cls.MOUNTPOINT], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if result.returncode != 0:
+            # Never mounted, e.g. after a mount timeout: the process has not daemonized yet,
+            # so stop it rather than waiting on it forever
+            cls.fuse_process.terminate()
         cls.fuse_process.wait()
 
-        # Remove mountpoint directory
-        shutil.rmtree(cls.MOUNTPOINT, ignore_errors=True)
 
-        # Cleanup temporary files
-        temp_files = ['/tmp/combined_splits', '/tmp/write_test_output', '/tmp/non_existent_test_output', '/tmp/dd_output']
-        for f in temp_files:
-            try:
-                os.remove(f)
-            except FileNotFoundError:
-                pass
+class FuseFilesystemTest(_FuseMountTestCase):
+    BASE_NAME = os.path.basename(SOURCE_FILE)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        # List the splits once for all tests
+        files = os.listdir(cls.MOUNTPOINT)
+        try:
+            cls._files_sorted = sorted(files, key=_split_index)
+        except ValueError:
+            # Leave badly named splits for test_2_directory_listing to report
+            cls._files_sorted = sorted(files)
+        cls._expected_splits = (cls._source_size + cls.SPLIT_SIZE - 1) // cls.SPLIT_SIZE
+        cls._expected_files = [f"{i}_{cls.BASE_NAME}" for i in range(cls._expected_splits)]
 
     def test_1_mounting(self):
         # Check if mounted
@@ -54,69 +197,64 @@ class FuseFilesystemTest(unittest.TestCase):
         self.assertTrue(mounted, "Filesystem did not mount successfully.")
 
     def test_2_directory_listing(self):
-        # List root directory contents
-        files = os.listdir(self.MOUNTPOINT)
-
-        source_size = os.stat(self.SOURCE_FILE).st_size
-        expected_splits = (source_size + self.SPLIT_SIZE - 1) // self.SPLIT_SIZE
+        # Root directory contents
+        files = self._files_sorted
+        expected_splits = self._expected_splits
 
         self.assertEqual(len(files), expected_splits, f"Expected {expected_splits} splits, found {len(files)}.")
-
-        expected_files = [f"{i}_{self.BASE_NAME}" for i in range(expected_splits)]
-        self.assertListEqual(sorted(files), sorted(expected_files), "Split file names do not match expected pattern.")
+        self.assertEqual(files, self._expected_files, "Split file names do not match expected pattern.")
 
     def test_3_file_attributes(self):
-        files = os.listdir(self.MOUNTPOINT)
-        source_size = os.stat(self.SOURCE_FILE).st_size
-        expected_splits = (source_size + self.SPLIT_SIZE - 1) // self.SPLIT_SIZE
-
-        for i, file in enumerate(sorted(files)):
-            file_path = os.path.join(self.MOUNTPOINT, file)
-            st = os.stat(file_path)
-
-            # Check permissions
-            perms = oct(st.st_mode & 0o777)
-            self.assertEqual(perms, '0o444', f"Incorrect permissions on {file} (found {perms}).")
-
-            if i < expected_splits - 1:
-                expected_size = self.SPLIT_SIZE
-            else:
-                expected_size = source_size - self.SPLIT_SIZE * (expected_splits - 1)
+        # Every split is full except the last one, which holds the remainder
+        full_splits = self._expected_splits - 1
+        sizes = [self.SPLIT_SIZE] * full_splits + [self._source_size - self.SPLIT_SIZE * full_splits]
+
+        # Order the entries like the cached listing, so that badly named splits fail the checks below
+        with os.scandir(self.MOUNTPOINT) as it:
+            entries_by_name = {entry.name: entry for entry in it}
+        entries = [entries_by_name[name] for name in self._files_sorted if name in entries_by_name]
+
+        # Check permissions of all splits at once
+        modes = [entry.stat(follow_symlinks=False).st_mode & 0o777 for entry in entries]
+        bad = [(entry.name, oct(mode)) for entry, mode in zip(entries, modes) if mode != 0o444]
+        self.assertFalse(bad, f"Incorrect permissions, expected 0o444 on: {bad}.")
+
+        # zip() stops at the shorter list, so make sure every split gets its size checked
+        self.assertEqual(len(entries), len(sizes), f"Expected {len(sizes)} splits, found {len(entries)}.")
+        for entry, expected_size in zip(entries, sizes):
+            file = entry.name
+            st = entry.stat(follow_symlinks=False)
             self.assertEqual(st.st_size, expected_size, f"Incorrect size on {file} (expected {expected_size}, found {st.st_size}).")
 
     def test_4_reading_split_files(self):
-        # Copy each split file to /tmp
-        files = os.listdir(self.MOUNTPOINT)
-        for file in files:
-            src = os.path.join(self.MOUNTPOINT, file)
-            dst = os.path.join('/tmp', f'split_{file}')
-            shutil.copyfile(src, dst)
-
-        # Concatenate split files
-        with open('/tmp/combined_splits', 'wb') as outfile:
-            for file in sorted(files, key=lambda x: int(x.split('_')[0])):
-                with open(os.path.join('/tmp', f'split_{file}'), 'rb') as infile:
-                    outfile.write(infile.read())
+        # Concatenate split files straight from the mountpoint
+        combined_splits_path = os.path.join(self._tmp_dir, 'combined_splits')
+        _combine_splits(self.MOUNTPOINT, self._files_sorted, combined_splits_path, self.READ_WORKERS)
 
         # Compare with original source file
-        with open(self.SOURCE_FILE, 'rb') as f1, open('/tmp/combined_splits', 'rb') as f2:
-            self.assertEqual(f1.read(), f2.read(), "Combined splits do not match the source file.")
+        offset = _first_difference(self.SOURCE_FILE, combined_splits_path)
+        self.assertIsNone(offset, f"Combined splits do not match the source file (first difference at offset {offset}).")
 
     def test_5_read_beyond_eof(self):
         # Identify the last split file
-        files = os.listdir(self.MOUNTPOINT)
-        last_split = sorted(files, key=lambda x: int(x.split('_')[0]))[-1]
+        last_split = self._files_sorted[-1]
         file_path = os.path.join(self.MOUNTPOINT, last_split)
 
+        # The last split must not extend past SPLIT_SIZE
+        st = os.stat(file_path)
+        self.assertLessEqual(st.st_size, self.SPLIT_SIZE, f"Last split is larger than {self.SPLIT_SIZE} bytes.")
+
         # Attempt to read beyond EOF
-        with open(file_path, 'rb') as f:
-            f.seek(self.SPLIT_SIZE)
-            data = f.read(1)
-            self.assertEqual(len(data), 0, "Data read beyond EOF.")
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            data = os.pread(fd, 1, self.SPLIT_SIZE)
+        finally:
+            os.close(fd)
+        self.assertEqual(len(data), 0, "Data read beyond EOF.")
 
     def test_6_write_access_denied(self):
         # Try to write to a split file
-        first_file = sorted(os.listdir(self.MOUNTPOINT))[0]
+        first_file = self._files_sorted[0]
         file_path = os.path.join(self.MOUNTPOINT, first_file)
 
         with self.assertRaises(PermissionError, msg="Write operation succeeded unexpectedly."):
@@ -129,72 +267,37 @@ class FuseFilesystemTest(unittest.TestCase):
         with self.assertRaises(FileNotFoundError, msg="Non-existent file accessed unexpectedly."):
             os.stat(non_existent_file)
 
-class FuseFilesystemDynamicTest(unittest.TestCase):
-    FUSE_PROGRAM = '../build/splinterfs'
-    SOURCE_FILE = SOURCE_FILE
-    MOUNTPOINT = '/tmp/' + ''.join(random.choices(string.ascii_letters, k=8))
-    SPLIT_SIZE = 100048576
+class FuseFilesystemDynamicTest(_FuseMountTestCase):
+    @classmethod
+    def prepare_source(cls):
+        # Mount a copy of the source file in the scratch directory, which the tests are free to modify
+        cls.temp_source_file_path = os.path.join(cls._tmp_dir, os.path.basename(cls.SOURCE_FILE))
+        shutil.copyfile(cls.SOURCE_FILE, cls.temp_source_file_path)
+        return cls.temp_source_file_path
 
     def setUp(self):
-        # Create mountpoint directory
-        os.makedirs(self.MOUNTPOINT, exist_ok=True)
-
-    def tearDown(self):
-        # Remove mountpoint directory
-        shutil.rmtree(self.MOUNTPOINT, ignore_errors=True)
-        # Cleanup temporary files
-        temp_files = ['/tmp/combined_splits_dynamic']
-        for f in temp_files:
-            try:
-                os.remove(f)
-            except FileNotFoundError:
-                pass
+        # Reset the temporary source file to a pristine copy of the source
+        os.truncate(self.temp_source_file_path, self._source_size)
 
     def test_dynamic_source_file_change(self):
-        # Create a temporary file which is a copy of the source file
-        with tempfile.NamedTemporaryFile(delete=False) as temp_source_file:
-            temp_source_file_path = temp_source_file.name
-        shutil.copyfile(self.SOURCE_FILE, temp_source_file_path)
-
-        # Start the FUSE filesystem on the temporary file
-        fuse_process = subprocess.Popen([self.FUSE_PROGRAM, temp_source_file_path, self.MOUNTPOINT])
-        time.sleep(2)  # Wait for filesystem to initialize
-
-        try:
-            # Append the original source file to the temporary file
-            with open(temp_source_file_path, 'ab') as temp_file, open(self.SOURCE_FILE, 'rb') as source_file:
-                temp_file.write(source_file.read())
-
-            # Wait a moment to ensure the filesystem notices the change
-            time.sleep(1)
+        # Append the original source file to the temporary file
+        _append_file(self.SOURCE_FILE, self.temp_source_file_path)
 
-            # Read all the splits from the mountpoint and combine them into one file
-            files = os.listdir(self.MOUNTPOINT)
-            combined_splits_path = '/tmp/combined_splits_dynamic'
+        # Wait until the filesystem notices the change
+        _wait_for_size(self.MOUNTPOINT, os.stat(self.temp_source_file_path).st_size)
 
-            with open(combined_splits_path, 'wb') as outfile:
-                for file in sorted(files, key=lambda x: int(x.split('_')[0])):
-                    with open(os.path.join(self.MOUNTPOINT, file), 'rb') as infile:
-                        outfile.write(infile.read())
-
-            with open(combined_splits_path, 'rb') as f:
-                combined_splits_hash = hashlib.sha256(f.read()).hexdigest()
-
-            with open(temp_source_file_path, 'rb') as f:
-                temp_source_file_hash = hashlib.sha256(f.read()).hexdigest()
+        # Read all the splits from the mountpoint and combine them into one file
+        files = os.listdir(self.MOUNTPOINT)
+        combined_splits_path = os.path.join(self._tmp_dir, 'combined_splits_dynamic')
+        _combine_splits(self.MOUNTPOINT, sorted(files, key=_split_index),
+                        combined_splits_path, self.READ_WORKERS)
 
-            # Compare the two hashes
-            self.assertEqual(combined_splits_hash, temp_source_file_hash,
-                             "Hashes do not match after source file change.")
+        combined_splits_hash = _sha256_file(combined_splits_path)
+        temp_source_file_hash = _sha256_file(self.temp_source_file_path)
 
-        finally:
-            # Unmount the filesystem
-            subprocess.run(['fusermount', '-u', self.MOUNTPOINT], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            fuse_process.wait()
-            # Remove temporary files
-            os.remove(temp_source_file_path)
-            if os.path.exists(combined_splits_path):
-                os.remove(combined_splits_path)
+        # Compare the two hashes
+        self.assertEqual(combined_splits_hash, temp_source_file_hash,
+                         "Hashes do not match after source file change.")
 
 if __name__ == '__main__':
     unittest.main()